@@ -1,9 +1,19 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
-import requests
+import tempfile
+import time
 from io import BytesIO
+from typing import BinaryIO, NamedTuple
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
+import httpx
+import orjson
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, constants
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -11,6 +21,8 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
+    PicklePersistence,
+    PersistenceInput,
 )
 
 # --- Configuration ---
@@ -20,7 +32,54 @@ ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 # Default voice if user hasn't selected one or if API call for voices fails
 DEFAULT_ELEVENLABS_VOICE_ID = os.getenv("DEFAULT_ELEVENLABS_VOICE_ID", "21m00Tcm4TlvDq8ikWAM") # Rachel
 
+# Webhook mode: Telegram pushes updates to PUBLIC_URL instead of the bot polling.
+# Leave USE_WEBHOOK unset for local development to keep using polling.
+USE_WEBHOOK = os.getenv("USE_WEBHOOK", "").lower() in ("1", "true", "yes")
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+PORT = int(os.getenv("PORT", "8080"))
+TG_SECRET = os.getenv("TG_SECRET")  # Optional, verifies that updates come from Telegram
+
 ELEVENLABS_API_BASE_URL = "https://api.elevenlabs.io/v1"
+ELEVENLABS_MODEL_ID = "eleven_multilingual_v2"
+ELEVENLABS_VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.75}
+
+# Synthesized audio is cached so repeated phrases don't cost another API call.
+# The cache is bounded by the total size of the cached clips, not their count.
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(32 << 20)))
+TTS_CACHE_TTL = int(os.getenv("TTS_CACHE_TTL", str(24 * 3600)))  # seconds
+
+# Streamed audio is buffered in memory up to this size, then spills to a temp file.
+# Only clips that fit in memory are kept in the TTS cache.
+TTS_SPOOL_MAX_BYTES = 1 << 20
+TTS_STREAM_CHUNK_SIZE = 16384
+
+# The voice catalog rarely changes, so it is cached in memory and on disk
+VOICES_TTL = int(os.getenv("VOICES_TTL", "3600"))  # seconds
+VOICES_CACHE_FILE = os.getenv("VOICES_CACHE_FILE", "voices.json")
+
+# Circuit breaker: stop calling ElevenLabs for a while after repeated failures
+ELEVENLABS_BREAKER_FAIL_MAX = int(os.getenv("ELEVENLABS_BREAKER_FAIL_MAX", "5"))
+ELEVENLABS_BREAKER_RESET_TIMEOUT = float(os.getenv("ELEVENLABS_BREAKER_RESET_TIMEOUT", "30"))  # seconds
+
+# Retries for transient ElevenLabs failures (connection errors, 429, 5xx)
+ELEVENLABS_MAX_ATTEMPTS = int(os.getenv("ELEVENLABS_MAX_ATTEMPTS", "3"))
+ELEVENLABS_RETRY_MAX_WAIT = float(os.getenv("ELEVENLABS_RETRY_MAX_WAIT", "4"))  # seconds
+
+# Timeouts sit a little above typical latency so stuck calls fail fast.
+# TTS read time grows with text length: base + per-character allowance, capped.
+TTS_READ_TIMEOUT_BASE = 5.0  # seconds
+TTS_READ_TIMEOUT_PER_CHAR = 0.05  # seconds
+TTS_READ_TIMEOUT_MAX = 60.0  # seconds
+VOICES_TIMEOUT = httpx.Timeout(5.0, connect=2.0)
+
+# Number of workers synthesizing queued TTS requests in parallel
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "8"))
+
+# Per-user settings (selected voice) are persisted here so they survive restarts
+BOT_STATE_FILE = os.getenv("BOT_STATE_FILE", "bot_state.pkl")
+
+# Comma-separated Telegram user IDs allowed to run admin commands
+ADMIN_USER_IDS = [int(uid) for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()]
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -28,14 +87,308 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- HTTP Client ---
+# Shared across all handlers so TCP/TLS connections to ElevenLabs are reused
+# instead of being re-established on every request. Retries are handled by the
+# tenacity policies below.
+_http = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+
+# Caps how many ElevenLabs requests are in flight at once (bulkhead), so a burst
+# of chats can't exhaust the connection pool or trip provider rate limits.
+ELEVENLABS_MAX_CONCURRENCY = int(os.getenv("ELEVENLABS_MAX_CONCURRENCY", "8"))
+_eleven_semaphore = asyncio.Semaphore(ELEVENLABS_MAX_CONCURRENCY)
+
+# --- Request Templates ---
+# Headers and URLs only depend on configuration, so they are built once
+_VOICES_URL = f"{ELEVENLABS_API_BASE_URL}/voices"
+_VOICES_HEADERS = {"Accept": "application/json", "xi-api-key": ELEVENLABS_API_KEY}
+_TTS_URL_TMPL = ELEVENLABS_API_BASE_URL + "/text-to-speech/%s/stream"
+_TTS_HEADERS = {
+    "Accept": "audio/mpeg",
+    "Content-Type": "application/json",
+    "xi-api-key": ELEVENLABS_API_KEY,
+}
+
+# --- Request Bodies ---
+# Everything but the text is constant, so the JSON tail is serialized once
+_TTS_BODY_SUFFIX = (
+    b',"model_id":' + orjson.dumps(ELEVENLABS_MODEL_ID)
+    + b',"voice_settings":' + orjson.dumps(ELEVENLABS_VOICE_SETTINGS) + b"}"
+)
+
+def _tts_request_body(text: str) -> bytes:
+    """Builds the JSON body for a TTS request."""
+    return b'{"text":' + orjson.dumps(text) + _TTS_BODY_SUFFIX
+
+# --- Circuit Breaker ---
+class CircuitBreaker:
+    """
+    Minimal asyncio-friendly circuit breaker.
+    After `fail_max` consecutive failures the breaker opens and callers should
+    skip the request entirely; once `reset_timeout` seconds have passed a single
+    trial request is let through (half-open) to probe whether the API recovered.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name: str, fail_max: int, reset_timeout: float) -> None:
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuit breaker '{self.name}' changed state: {self.state} -> {state}")
+            self.state = state
+
+    def allow_request(self) -> bool:
+        """Returns False while the breaker is open and requests should fail fast."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._set_state(self.HALF_OPEN)
+            return True
+        # Only one trial request at a time while half-open
+        return self.state == self.CLOSED
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.fail_max:
+            self._opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+_eleven_breaker = CircuitBreaker("elevenlabs", ELEVENLABS_BREAKER_FAIL_MAX, ELEVENLABS_BREAKER_RESET_TIMEOUT)
+
+def _is_provider_failure(response: httpx.Response) -> bool:
+    """Rate limiting and server errors count against the breaker; client errors don't."""
+    return response.status_code == 429 or response.status_code >= 500
+
+# --- Retries ---
+_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+_backoff = wait_random_exponential(multiplier=0.3, max=ELEVENLABS_RETRY_MAX_WAIT)
+
+# Errors raised before the request reached ElevenLabs, so retrying can't cause double billing
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+def _is_retryable_status(exc: BaseException) -> bool:
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in _RETRYABLE_STATUS_CODES
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Retries transient errors only, and never once the breaker has opened."""
+    if _eleven_breaker.state == CircuitBreaker.OPEN:
+        return False
+    return isinstance(exc, httpx.TransportError) or _is_retryable_status(exc)
+
+def _is_retryable_tts(exc: BaseException) -> bool:
+    """
+    Like _is_retryable, but for TTS, where ElevenLabs bills the characters once it
+    accepts the request: read timeouts or dropped streams are not retried.
+    """
+    if _eleven_breaker.state == CircuitBreaker.OPEN:
+        return False
+    return isinstance(exc, _CONNECT_ERRORS) or _is_retryable_status(exc)
+
+def _retry_wait(retry_state) -> float:
+    """Honors Retry-After on rate limiting, otherwise uses jittered exponential backoff."""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError):
+        retry_after = exc.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), ELEVENLABS_RETRY_MAX_WAIT)
+    return _backoff(retry_state)
+
+_with_retries = retry(
+    retry=retry_if_exception(_is_retryable),
+    stop=stop_after_attempt(ELEVENLABS_MAX_ATTEMPTS),
+    wait=_retry_wait,
+    reraise=True,
+)
+
+_with_tts_retries = retry(
+    retry=retry_if_exception(_is_retryable_tts),
+    stop=stop_after_attempt(ELEVENLABS_MAX_ATTEMPTS),
+    wait=_retry_wait,
+    reraise=True,
+)
+
+@_with_retries
+async def _elevenlabs_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Sends a request to ElevenLabs, raising httpx errors for non-2xx responses."""
+    async with _eleven_semaphore:
+        response = await _http.request(method, url, **kwargs)
+    response.raise_for_status()
+    return response
+
+@_with_tts_retries
+async def _elevenlabs_stream(method: str, url: str, **kwargs) -> tuple[tempfile.SpooledTemporaryFile, int]:
+    """
+    Streams an ElevenLabs response body into a spooled temp file.
+    Returns the file (rewound) and the number of bytes written.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=TTS_SPOOL_MAX_BYTES)
+    size = 0
+    try:
+        async with _eleven_semaphore:
+            async with _http.stream(method, url, **kwargs) as response:
+                if response.is_error:
+                    await response.aread()  # so error logging can include the body
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(TTS_STREAM_CHUNK_SIZE):
+                    out.write(chunk)
+                    size += len(chunk)
+    except BaseException:
+        out.close()
+        raise
+    out.seek(0)
+    return out, size
+
+# --- TTS Cache ---
+_tts_cache: TTLCache = TTLCache(maxsize=TTS_CACHE_MAX_BYTES, ttl=TTS_CACHE_TTL, getsizeof=len)
+
+# TTS requests currently being synthesized, keyed like the cache
+class _InflightTTS:
+    """Shared state for callers coalesced onto one TTS request."""
+
+    def __init__(self) -> None:
+        # Resolves to the audio bytes, or None if the request failed
+        self.future: asyncio.Future[bytes | None] = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+
+_tts_inflight: dict[bytes, _InflightTTS] = {}
+
+def _tts_timeout(text: str) -> httpx.Timeout:
+    """Length-aware timeout for a TTS request."""
+    read = min(TTS_READ_TIMEOUT_MAX, TTS_READ_TIMEOUT_BASE + TTS_READ_TIMEOUT_PER_CHAR * len(text))
+    return httpx.Timeout(connect=3.0, read=read, write=10.0, pool=5.0)
+
+def _tts_cache_key(text: str, voice_id: str) -> bytes:
+    """Builds a compact cache key from everything that affects the audio output."""
+    settings = ELEVENLABS_VOICE_SETTINGS
+    raw = f"{voice_id}|{ELEVENLABS_MODEL_ID}|{settings['stability']}|{settings['similarity_boost']}|{text}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+# --- Voices Cache ---
+# (monotonic timestamp of the fetch, list of voices)
+_voices_cache: tuple[float, list] | None = None
+# Inline keyboard for /voices, rebuilt only when the cached list changes
+_voices_markup: InlineKeyboardMarkup | None = None
+# (voice_id, voice_name) per button; callback_data only carries "v:GEN:INDEX" so
+# it stays well under Telegram's 64-byte limit. GEN is a digest of the table, so
+# buttons from an older /voices reply are rejected once the list has changed,
+# but keep working across refetches and restarts that yield the same list.
+_voice_table: list[tuple[str, str]] = []
+_voice_table_gen = ""
+
+def _voice_table_generation(table: list[tuple[str, str]]) -> str:
+    """Short digest identifying a voice table's contents and order."""
+    raw = "\n".join(f"{voice_id}|{voice_name}" for voice_id, voice_name in table)
+    return hashlib.blake2b(raw.encode(), digest_size=4).hexdigest()
+
+def _build_voices_markup(table: list[tuple[str, str]], gen: str) -> InlineKeyboardMarkup | None:
+    """Builds the voice selection keyboard, or None if there is nothing to show."""
+    keyboard = []
+    row = []
+    # Limit to a reasonable number of buttons or implement pagination if many voices
+    # For ElevenLabs default voices, the number is usually manageable (around 10-30)
+    for index, (_, voice_name) in enumerate(table):
+        button = InlineKeyboardButton(voice_name, callback_data=f"v:{gen}:{index}")
+        row.append(button)
+        if len(row) == 2: # 2 buttons per row
+            keyboard.append(row)
+            row = []
+    if row: # Add remaining buttons if any
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+def _set_voices_cache(fetched_at: float, voices: list) -> None:
+    """Stores the voices list and precomputes its keyboard."""
+    global _voices_cache, _voices_markup, _voice_table, _voice_table_gen
+    _voices_cache = (fetched_at, voices)
+    # Displaying up to 20 voices for now
+    _voice_table = [(voice["voice_id"], voice["name"]) for voice in voices[:20]]
+    _voice_table_gen = _voice_table_generation(_voice_table)
+    _voices_markup = _build_voices_markup(_voice_table, _voice_table_gen)
+
+def _load_voices_cache_file() -> tuple[float, list] | None:
+    """Loads the voices list persisted by a previous run, if any."""
+    try:
+        with open(VOICES_CACHE_FILE, encoding="utf-8") as f:
+            stored = json.load(f)
+        age = time.time() - float(stored["fetched_at"])
+        if not isinstance(stored["voices"], list):
+            raise TypeError("'voices' is not a list")
+        # Rebuilt field by field so a malformed entry fails here, not at startup
+        voices = [
+            {"name": str(voice["name"]), "voice_id": str(voice["voice_id"])}
+            for voice in stored["voices"]
+        ]
+        return time.monotonic() - age, voices
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable voices cache file {VOICES_CACHE_FILE}: {e}")
+        return None
+
+def _save_voices_cache_file(voices: list) -> None:
+    """Persists the voices list so cold starts can skip the first fetch."""
+    try:
+        with open(VOICES_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": time.time(), "voices": voices}, f)
+    except OSError as e:
+        logger.warning(f"Could not write voices cache file {VOICES_CACHE_FILE}: {e}")
+
+def clear_voices_cache() -> None:
+    """Drops the cached voices list, both in memory and on disk."""
+    global _voices_cache, _voices_markup
+    _voices_cache = None
+    _voices_markup = None
+    try:
+        os.remove(VOICES_CACHE_FILE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove voices cache file {VOICES_CACHE_FILE}: {e}")
+
+def _voices_cache_is_fresh() -> bool:
+    """True if the cached voices list is younger than VOICES_TTL."""
+    return _voices_cache is not None and time.monotonic() - _voices_cache[0] < VOICES_TTL
+
+if (_stored_voices := _load_voices_cache_file()) is not None:
+    _set_voices_cache(*_stored_voices)
+
 # --- ElevenLabs API Functions ---
-async def fetch_elevenlabs_voices(api_key: str) -> list | None:
-    """Fetches available voices from ElevenLabs."""
-    voices_url = f"{ELEVENLABS_API_BASE_URL}/voices"
-    headers = {"Accept": "application/json", "xi-api-key": api_key}
+async def fetch_elevenlabs_voices() -> list | None:
+    """Fetches available voices from ElevenLabs, served from cache within VOICES_TTL."""
+    if _voices_cache_is_fresh():
+        return _voices_cache[1]
+
+    if not _eleven_breaker.allow_request():
+        logger.warning("ElevenLabs circuit breaker is open; skipping voices fetch.")
+        return None
+
     try:
-        response = requests.get(voices_url, headers=headers, timeout=10)
-        response.raise_for_status()
+        started = time.monotonic()
+        response = await _elevenlabs_request("GET", _VOICES_URL, headers=_VOICES_HEADERS, timeout=VOICES_TIMEOUT)
+        # httpx negotiates gzip and HTTP/2 itself; log what the server actually used
+        logger.info(
+            f"ElevenLabs voices fetch took {time.monotonic() - started:.2f}s "
+            f"({response.http_version}, encoding: {response.headers.get('Content-Encoding', 'identity')}, "
+            f"{response.num_bytes_downloaded} bytes on the wire)."
+        )
+        _eleven_breaker.record_success()
         voices_data = response.json()
         # We only care about predefined voices usually, filter if necessary
         # For simplicity, taking all for now.
@@ -50,50 +403,175 @@ async def fetch_elevenlabs_voices(api_key: str) -> list | None:
             for voice in voices_data.get("voices", [])
         ]
         logger.info(f"Fetched {len(available_voices)} voices from ElevenLabs.")
+        _set_voices_cache(time.monotonic(), available_voices)
+        _save_voices_cache_file(available_voices)
         return available_voices
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f"ElevenLabs HTTP error fetching voices: {http_err} - Response: {response.text if 'response' in locals() else 'N/A'}")
+    except httpx.HTTPStatusError as http_err:
+        logger.error(f"ElevenLabs HTTP error fetching voices: {http_err} - Response: {http_err.response.text}")
+        if _is_provider_failure(http_err.response):
+            _eleven_breaker.record_failure()
+        else:
+            _eleven_breaker.record_success()
         return None
-    except requests.exceptions.RequestException as req_err:
+    except httpx.RequestError as req_err:
         logger.error(f"ElevenLabs Request error fetching voices: {req_err}")
+        _eleven_breaker.record_failure()
         return None
     except Exception as e:
         logger.error(f"Unexpected error fetching ElevenLabs voices: {e}")
+        _eleven_breaker.record_failure()
         return None
 
-def generate_tts_elevenlabs(text: str, voice_id: str, api_key: str) -> bytes | None:
+async def generate_tts_elevenlabs(text: str, voice_id: str) -> BinaryIO | None:
     """
     Generates speech from text using ElevenLabs API.
-    Returns audio content as bytes, or None if an error occurs.
+    Returns a file-like object with the MP3 audio, or None if an error occurs.
+    The caller is responsible for closing it.
+    Results are served from the in-memory cache when available, and concurrent
+    identical requests share a single API call.
     """
-    tts_url = f"{ELEVENLABS_API_BASE_URL}/text-to-speech/{voice_id}"
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": api_key,
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {"stability": 0.5, "similarity_boost": 0.75},
-    }
+    cache_key = _tts_cache_key(text, voice_id)
+    cached = _tts_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"TTS cache hit for voice {voice_id}.")
+        return BytesIO(cached)
+
+    inflight = _tts_inflight.get(cache_key)
+    if inflight is not None:
+        inflight.waiters += 1
+        # Shielded so a cancelled waiter doesn't cancel the shared future
+        audio_content = await asyncio.shield(inflight.future)
+        if audio_content is None:
+            return None
+        logger.info(f"TTS request for voice {voice_id} coalesced with one in flight.")
+        return BytesIO(audio_content)
+
+    inflight = _tts_inflight[cache_key] = _InflightTTS()
+    audio_file = None
+    try:
+        audio_file = await _synthesize_tts(text, voice_id, cache_key)
+        if audio_file is not None and inflight.waiters and not isinstance(audio_file, BytesIO):
+            # A clip too large to cache spilled to disk; waiters need the bytes anyway
+            with audio_file:
+                audio_file = BytesIO(audio_file.read())
+        return audio_file
+    finally:
+        del _tts_inflight[cache_key]
+        shared = audio_file.getvalue() if isinstance(audio_file, BytesIO) and inflight.waiters else None
+        inflight.future.set_result(shared)
+
+async def _synthesize_tts(text: str, voice_id: str, cache_key: bytes) -> BinaryIO | None:
+    """Calls the ElevenLabs TTS API and caches clips small enough to keep in memory."""
+    if not _eleven_breaker.allow_request():
+        logger.warning("ElevenLabs circuit breaker is open; skipping TTS request.")
+        return None
+
+    tts_url = _TTS_URL_TMPL % voice_id
 
     try:
-        response = requests.post(tts_url, json=data, headers=headers, timeout=60)
-        response.raise_for_status()
-        return response.content
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f"ElevenLabs TTS HTTP error: {http_err} - Response: {response.text}")
-        if response.status_code == 401:
+        started = time.monotonic()
+        audio_file, size = await _elevenlabs_stream(
+            "POST", tts_url, content=_tts_request_body(text), headers=_TTS_HEADERS, timeout=_tts_timeout(text)
+        )
+        logger.info(f"ElevenLabs TTS for {len(text)} chars took {time.monotonic() - started:.2f}s ({size} bytes).")
+        _eleven_breaker.record_success()
+    except httpx.HTTPStatusError as http_err:
+        logger.error(f"ElevenLabs TTS HTTP error: {http_err} - Response: {http_err.response.text}")
+        if http_err.response.status_code == 401:
             logger.error("ElevenLabs API Key is invalid or missing for TTS.")
+        if _is_provider_failure(http_err.response):
+            _eleven_breaker.record_failure()
+        else:
+            _eleven_breaker.record_success()
         return None
-    except requests.exceptions.RequestException as req_err:
+    except httpx.RequestError as req_err:
         logger.error(f"ElevenLabs TTS Request error: {req_err}")
+        _eleven_breaker.record_failure()
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred with ElevenLabs TTS API: {e}")
+        _eleven_breaker.record_failure()
         return None
 
+    if size > TTS_SPOOL_MAX_BYTES:
+        return audio_file
+    # Still held in memory, so caching it costs no extra disk reads
+    with audio_file:
+        audio_content = audio_file.read()
+    if size <= _tts_cache.maxsize:  # TTLCache raises for items larger than the whole budget
+        _tts_cache[cache_key] = audio_content
+    return BytesIO(audio_content)
+
+# --- TTS Worker Pool ---
+# Incoming messages are queued and synthesized by a fixed number of workers,
+# which smooths bursts and bounds outbound load on ElevenLabs.
+class _TTSJob(NamedTuple):
+    text: str
+    voice_id: str
+    future: asyncio.Future
+
+_tts_queue: asyncio.Queue[_TTSJob] = asyncio.Queue()
+_tts_workers: list[asyncio.Task] = []
+# Per chat, the turn of the most recently received message. Each voice reply
+# waits for the previous message's turn, so replies go out in arrival order.
+_chat_turns: dict[int, asyncio.Future] = {}
+
+async def _tts_worker(worker_id: int) -> None:
+    """Pulls jobs off the TTS queue and resolves their futures with the audio."""
+    while True:
+        job = await _tts_queue.get()
+        try:
+            if job.future.cancelled():
+                continue
+            audio_file = await generate_tts_elevenlabs(job.text, job.voice_id)
+            if job.future.cancelled():
+                if audio_file:
+                    audio_file.close()
+            else:
+                job.future.set_result(audio_file)
+        except Exception as e:
+            logger.error(f"TTS worker {worker_id} failed: {e}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            _tts_queue.task_done()
+
+def start_tts_workers() -> None:
+    """Starts the TTS worker tasks on the running event loop."""
+    for worker_id in range(TTS_WORKERS):
+        _tts_workers.append(asyncio.create_task(_tts_worker(worker_id)))
+    logger.info(f"Started {TTS_WORKERS} TTS workers.")
+
+async def stop_tts_workers() -> None:
+    """Cancels the TTS worker tasks and waits for them to finish."""
+    for task in _tts_workers:
+        task.cancel()
+    await asyncio.gather(*_tts_workers, return_exceptions=True)
+    _tts_workers.clear()
+
+async def synthesize_speech(text: str, voice_id: str) -> BinaryIO | None:
+    """Queues a TTS request for the worker pool and waits for its audio."""
+    future = asyncio.get_running_loop().create_future()
+    await _tts_queue.put(_TTSJob(text, voice_id, future))
+    return await future
+
+def _claim_chat_turn(chat_id: int) -> tuple[asyncio.Future | None, asyncio.Future]:
+    """
+    Queues a voice reply for a chat, returning the previous turn to wait for and
+    this reply's own turn. Must be called before the handler's first await, since
+    updates are processed concurrently and could otherwise overtake each other.
+    """
+    previous = _chat_turns.get(chat_id)
+    turn = _chat_turns[chat_id] = asyncio.get_running_loop().create_future()
+    return previous, turn
+
+def _release_chat_turn(chat_id: int, turn: asyncio.Future) -> None:
+    """Lets the chat's next voice reply proceed."""
+    if not turn.done():
+        turn.set_result(None)
+    if _chat_turns.get(chat_id) is turn:
+        del _chat_turns[chat_id]
+
 # --- Telegram Bot Handlers ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a more attractive welcome message."""
@@ -132,7 +610,7 @@ async def voices_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
-    voices = await fetch_elevenlabs_voices(ELEVENLABS_API_KEY)
+    voices = await fetch_elevenlabs_voices()
 
     if not voices:
         await update.message.reply_text(
@@ -140,29 +618,17 @@ async def voices_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    if not voices: # Double check after potential modification in fetch_elevenlabs_voices
-        await update.message.reply_text("No voices found or an error occurred.")
-        return
-
-    keyboard = []
-    row = []
-    # Limit to a reasonable number of buttons or implement pagination if many voices
-    # For ElevenLabs default voices, the number is usually manageable (around 10-30)
-    for voice in voices[:20]: # Displaying up to 20 voices for now
-        button = InlineKeyboardButton(voice["name"], callback_data=f"voice_{voice['voice_id']}_{voice['name']}")
-        row.append(button)
-        if len(row) == 2: # 2 buttons per row
-            keyboard.append(row)
-            row = []
-    if row: # Add remaining buttons if any
-        keyboard.append(row)
-
-    if not keyboard:
+    if _voices_markup is None:
         await update.message.reply_text("No voices available to display.")
         return
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Choose your desired voice:", reply_markup=reply_markup)
+    await update.message.reply_text("Choose your desired voice:", reply_markup=_voices_markup)
+
+async def refresh_voices_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin command: clears the cached voices list so the next /voices refetches it."""
+    clear_voices_cache()
+    logger.info(f"Voices cache cleared by user {update.effective_user.id}")
+    await update.message.reply_text("🔄 Voices cache cleared. The next /voices call will fetch a fresh list.")
 
 async def voice_selection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles voice selection from inline keyboard."""
@@ -170,15 +636,17 @@ async def voice_selection_callback(update: Update, context: ContextTypes.DEFAULT
     await query.answer() # Acknowledge callback
 
     try:
-        # callback_data is "voice_VOICEID_VOICENAME"
-        parts = query.data.split("_", 2)
-        if len(parts) < 3 or parts[0] != "voice":
-            logger.warning(f"Invalid callback data format: {query.data}")
-            await query.edit_message_text(text="Error processing selection. Invalid data.")
+        # callback_data is "v:GEN:INDEX" into _voice_table. Buttons from older
+        # releases ("voice_ID_NAME" or "v:INDEX") carry no generation and are expired.
+        parts = query.data.split(":")
+        gen = parts[1] if len(parts) == 3 else None
+        index = int(parts[-1]) if gen is not None else -1
+        if gen != _voice_table_gen or not 0 <= index < len(_voice_table):
+            logger.warning(f"Stale or invalid voice selection: {query.data}")
+            await query.edit_message_text(text="This voice list has expired. Please use /voices again.")
             return
 
-        voice_id = parts[1]
-        voice_name = parts[2].replace("_", " ") # Reconstruct name if it had underscores
+        voice_id, voice_name = _voice_table[index]
 
         context.user_data["voice_id"] = voice_id
         context.user_data["voice_name"] = voice_name
@@ -191,7 +659,11 @@ async def voice_selection_callback(update: Update, context: ContextTypes.DEFAULT
 
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles regular text messages and converts them to speech."""
+    """
+    Handles regular text messages and converts them to speech.
+    Replies right away with a placeholder and sends the audio from a background
+    task, so the handler returns without waiting for synthesis.
+    """
     user_text = update.message.text
     if not user_text:
         return
@@ -199,8 +671,6 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat_id = update.effective_chat.id
     logger.info(f"Received text from chat {chat_id}: '{user_text[:50]}...'")
 
-    await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.RECORD_VOICE)
-
     selected_voice_id = context.user_data.get("voice_id", DEFAULT_ELEVENLABS_VOICE_ID)
     selected_voice_name = context.user_data.get("voice_name", "Default")
 
@@ -208,27 +678,70 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Admin alert: ElevenLabs API key is not set. Cannot process TTS.")
         return
 
-    audio_content = generate_tts_elevenlabs(user_text, selected_voice_id, ELEVENLABS_API_KEY)
+    previous_turn, turn = _claim_chat_turn(chat_id)
+    try:
+        placeholder = await update.message.reply_text("🎙️ Generating…")
+    except BaseException:
+        _release_chat_turn(chat_id, turn)
+        raise
+    context.application.create_task(
+        _generate_and_send(
+            update, context, user_text, selected_voice_id, selected_voice_name, placeholder, previous_turn, turn
+        ),
+        update=update,
+    )
 
-    if audio_content:
-        audio_file = BytesIO(audio_content)
-        audio_file.name = "voice.mp3"
+async def _generate_and_send(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    text: str,
+    voice_id: str,
+    voice_name: str,
+    placeholder: Message,
+    previous_turn: asyncio.Future | None,
+    turn: asyncio.Future,
+) -> None:
+    """Synthesizes the text and replaces the placeholder message with the audio."""
+    chat_id = update.effective_chat.id
+    try:
+        if previous_turn is not None:
+            # Shielded so cancelling this task doesn't release the turn before ours
+            await asyncio.shield(previous_turn)
         try:
-            await update.message.reply_voice(voice=audio_file, caption=f"🎙️ Voice: {selected_voice_name}")
-            logger.info(f"Sent voice message to chat {chat_id} using voice {selected_voice_name}")
+            await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.RECORD_VOICE)
+            audio_file = await synthesize_speech(text, voice_id)
         except Exception as e:
-            logger.error(f"Error sending voice message: {e}")
-            await update.message.reply_text("Sorry, I encountered an error while sending the audio.")
-    else:
-        logger.warning(f"Failed to generate audio for text from chat {chat_id}")
-        await update.message.reply_text(
-            "Sorry, I couldn't convert your text to speech. 😔\n"
-            "This might be due to:\n"
-            "- An issue with the ElevenLabs API.\n"
-            "- Invalid or exhausted API key quota.\n"
-            "- The selected voice might be unavailable.\n\n"
-            "Please try again later or select a different voice using /voices."
-        )
+            logger.error(f"Error generating audio for chat {chat_id}: {e}")
+            audio_file = None
+
+        if audio_file:
+            try:
+                with audio_file:
+                    await update.message.reply_voice(
+                        voice=audio_file, filename="voice.mp3", caption=f"🎙️ Voice: {voice_name}"
+                    )
+                logger.info(f"Sent voice message to chat {chat_id} using voice {voice_name}")
+            except Exception as e:
+                logger.error(f"Error sending voice message: {e}")
+                await placeholder.edit_text("Sorry, I encountered an error while sending the audio.")
+                return
+            try:
+                await placeholder.delete()
+            except Exception as e:
+                # The audio already went out, so this is only cosmetic
+                logger.warning(f"Could not delete placeholder message in chat {chat_id}: {e}")
+        else:
+            logger.warning(f"Failed to generate audio for text from chat {chat_id}")
+            await placeholder.edit_text(
+                "Sorry, I couldn't convert your text to speech. 😔\n"
+                "This might be due to:\n"
+                "- An issue with the ElevenLabs API.\n"
+                "- Invalid or exhausted API key quota.\n"
+                "- The selected voice might be unavailable.\n\n"
+                "Please try again later or select a different voice using /voices."
+            )
+    finally:
+        _release_chat_turn(chat_id, turn)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log Errors caused by Updates."""
@@ -240,6 +753,34 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             logger.error(f"Failed to send error message to user: {e}")
 
 
+async def warm_up_elevenlabs() -> None:
+    """
+    Fills the voices cache and opens a pooled connection to ElevenLabs, so the
+    first user after a deploy doesn't pay for DNS, the TLS handshake and the fetch.
+    """
+    if not ELEVENLABS_API_KEY:
+        return
+    if _voices_cache_is_fresh():
+        # Voices came from disk, so no connection was opened yet
+        try:
+            await _http.head(_VOICES_URL, headers=_VOICES_HEADERS, timeout=VOICES_TIMEOUT)
+        except httpx.HTTPError as e:
+            logger.warning(f"ElevenLabs connection warm-up failed: {e}")
+    else:
+        await fetch_elevenlabs_voices()
+    logger.info("ElevenLabs warm-up finished.")
+
+async def on_startup(application: Application) -> None:
+    """Starts background workers and warms up ElevenLabs once the event loop is running."""
+    start_tts_workers()
+    await warm_up_elevenlabs()
+
+async def on_shutdown(application: Application) -> None:
+    """Stops background workers and closes the shared HTTP client."""
+    await stop_tts_workers()
+    await _http.aclose()
+
+
 def main() -> None:
     """Start the bot."""
     if not TELEGRAM_BOT_TOKEN:
@@ -251,17 +792,45 @@ def main() -> None:
 
     logger.info("🚀 Starting ElevenLabs TTS Bot...")
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    persistence = PicklePersistence(
+        filepath=BOT_STATE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+    )
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(True)  # ordering per chat is kept by _claim_chat_turn
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("voices", voices_command))
-    application.add_handler(CallbackQueryHandler(voice_selection_callback, pattern="^voice_"))
+    application.add_handler(
+        CommandHandler("refresh_voices", refresh_voices_command, filters=filters.User(user_id=ADMIN_USER_IDS))
+    )
+    application.add_handler(CallbackQueryHandler(voice_selection_callback, pattern=r"^(v:([0-9a-f]+:)?\d+$|voice_)"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_error_handler(error_handler)
 
-    logger.info("Bot is now polling for updates... 📡")
-    application.run_polling()
+    if USE_WEBHOOK:
+        if not PUBLIC_URL:
+            logger.critical("FATAL: USE_WEBHOOK is set but PUBLIC_URL is not. Exiting.")
+            return
+        logger.info(f"Bot is now listening for webhook updates on port {PORT}... 📡")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{PUBLIC_URL}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=TG_SECRET,
+        )
+    else:
+        logger.info("Bot is now polling for updates... 📡")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file